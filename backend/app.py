@@ -1,13 +1,23 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, g
+import click
+from flask.cli import AppGroup
 import sqlite3
 import os
 from flask_cors import CORS
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
-import io
 import json
+import mimetypes
+import tempfile
+from datetime import datetime, timezone
 import re
+import time
+import queue
+import threading
+from collections import OrderedDict
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from urllib.parse import quote
 ALLOWED_EXTENSIONS = {'pdf', 'jpg', 'jpeg', 'png'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -15,11 +25,31 @@ import csv
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
+# Default tenant keeps the original single-college layout next to app.py
 DB_PATH = os.path.join(os.path.dirname(__file__), 'student_mgmt.db')
+UPLOADS_DIR = os.path.join(os.path.dirname(__file__), 'uploads')
+SMS_DIR = os.path.join(os.path.dirname(__file__), 'SMS')
+# Other colleges live in TENANTS_DIR/<tenant>/ with their own DB, uploads/ and SMS/
+TENANTS_DIR = os.environ.get('SMS_TENANTS_DIR', os.path.join(os.path.dirname(__file__), 'tenants'))
+DEFAULT_TENANT = 'default'
+TENANT_HEADER = 'X-Tenant-ID'
+# Requests to <tenant>.<SMS_TENANT_DOMAIN> resolve the tenant from the subdomain
+TENANT_DOMAIN = os.environ.get('SMS_TENANT_DOMAIN', '').lower()
+TENANT_NAME_RE = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+MAX_OPEN_TENANTS = int(os.environ.get('SMS_MAX_OPEN_TENANTS', 32))
+DB_POOL_SIZE = 8
+# File serving mode: '' (stream from Python), 'x-sendfile' (Apache/lighttpd) or 'x-accel' (nginx)
+FILE_SERVE_MODE = os.environ.get('SMS_FILE_SERVE_MODE', '').lower()
+# nginx internal location for x-accel mode; files are redirected to X_ACCEL_PREFIX/<tenant>/<path in tenant root>:
+#   location /protected/default/ { internal; alias /path/to/backend/; }
+#   location /protected/ { internal; alias /path/to/SMS_TENANTS_DIR/; }
+X_ACCEL_PREFIX = os.environ.get('SMS_X_ACCEL_PREFIX', '/protected/')
+FILE_CACHE_MAX_AGE = 365 * 24 * 3600
+app.config['USE_X_SENDFILE'] = FILE_SERVE_MODE == 'x-sendfile'
 
 # --- Database Setup ---
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
+def init_db(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
     c = conn.cursor()
     # Courses table
     c.execute('''CREATE TABLE IF NOT EXISTS courses (
@@ -66,6 +96,12 @@ def init_db():
         note TEXT,
         FOREIGN KEY(student_id) REFERENCES students(id)
     )''')
+    # Add idempotency_key column if not exists
+    c.execute("PRAGMA table_info(fees_payments)")
+    columns = [row[1] for row in c.fetchall()]
+    if 'idempotency_key' not in columns:
+        c.execute('ALTER TABLE fees_payments ADD COLUMN idempotency_key TEXT')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_fees_payments_idempotency ON fees_payments(idempotency_key)')
     # Exam Forms table
     c.execute('''CREATE TABLE IF NOT EXISTS exam_forms (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -75,15 +111,518 @@ def init_db():
         created_at TEXT DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY(student_id) REFERENCES students(id)
     )''')
+    # Subjects catalog (per course/semester)
+    c.execute('''CREATE TABLE IF NOT EXISTS subjects (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        course_id INTEGER NOT NULL,
+        semester TEXT NOT NULL,
+        name TEXT NOT NULL,
+        UNIQUE(course_id, semester, name),
+        FOREIGN KEY(course_id) REFERENCES courses(id)
+    )''')
+    # Exam Form <-> Subject join table
+    c.execute('''CREATE TABLE IF NOT EXISTS exam_form_subjects (
+        exam_form_id INTEGER NOT NULL,
+        subject_id INTEGER NOT NULL,
+        position INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(exam_form_id, subject_id),
+        FOREIGN KEY(exam_form_id) REFERENCES exam_forms(id),
+        FOREIGN KEY(subject_id) REFERENCES subjects(id)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_exam_form_subjects_subject ON exam_form_subjects(subject_id, exam_form_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_exam_forms_student ON exam_forms(student_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_students_batch ON students(batch_id)')
+    migrate_exam_form_subjects(c)
+    init_change_tracking(c)
     conn.commit()
     conn.close()
 
-init_db()
+# Tables whose rows are exposed through /api/changes
+TRACKED_TABLES = ['students', 'fees_payments', 'exam_forms']
+
+def init_change_tracking(c):
+    # change_log holds the latest change per row (deletes stay as tombstones);
+    # seq is AUTOINCREMENT so it only ever increases
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'change_log'")
+    backfill = c.fetchone() is None
+    c.execute('''CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        changed_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_change_log_row ON change_log(table_name, row_id)')
+    for table in TRACKED_TABLES:
+        c.execute(f"PRAGMA table_info({table})")
+        columns = [row[1] for row in c.fetchall()]
+        if 'updated_at' not in columns:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN updated_at TEXT')
+        if 'change_seq' not in columns:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN change_seq INTEGER')
+        if backfill:
+            # Existing rows count as changes so a sync from 0 returns everything
+            c.execute(f"INSERT INTO change_log (table_name, row_id, op) SELECT '{table}', id, 'upsert' FROM {table} ORDER BY id")
+            c.execute(f'''UPDATE {table} SET updated_at = CURRENT_TIMESTAMP,
+                          change_seq = (SELECT seq FROM change_log WHERE table_name = '{table}' AND row_id = {table}.id)''')
+        record_change = f'''
+            DELETE FROM change_log WHERE table_name = '{table}' AND row_id = NEW.id;
+            INSERT INTO change_log (table_name, row_id, op) VALUES ('{table}', NEW.id, 'upsert');
+            UPDATE {table} SET change_seq = last_insert_rowid(), updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;'''
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_insert AFTER INSERT ON {table}
+                      BEGIN {record_change} END''')
+        # The WHEN clause skips the trigger's own change_seq update
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_update AFTER UPDATE ON {table}
+                      WHEN NEW.change_seq IS OLD.change_seq
+                      BEGIN {record_change} END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_delete AFTER DELETE ON {table}
+                      BEGIN
+                          DELETE FROM change_log WHERE table_name = '{table}' AND row_id = OLD.id;
+                          INSERT INTO change_log (table_name, row_id, op) VALUES ('{table}', OLD.id, 'delete');
+                      END''')
+    # Synced rows embed columns joined from other tables (student, course and batch names),
+    # so changes there are logged as changes to the dependent rows too
+    c.execute('CREATE INDEX IF NOT EXISTS idx_fees_payments_student ON fees_payments(student_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_students_course ON students(course_id)')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_students_update_payments
+                 AFTER UPDATE OF name, course_id, batch_id, year, semester ON students
+                 BEGIN
+                     UPDATE fees_payments SET updated_at = CURRENT_TIMESTAMP WHERE student_id = NEW.id;
+                 END''')
+    for table, column in (('courses', 'course_id'), ('batches', 'batch_id')):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_update_dependents
+                      AFTER UPDATE OF name ON {table}
+                      BEGIN
+                          UPDATE students SET updated_at = CURRENT_TIMESTAMP WHERE {column} = NEW.id;
+                          UPDATE fees_payments SET updated_at = CURRENT_TIMESTAMP
+                          WHERE student_id IN (SELECT id FROM students WHERE {column} = NEW.id);
+                      END''')
+    # Payments are only listed with their student, so deleting a student deletes them for sync clients
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_students_delete_payments AFTER DELETE ON students
+                 BEGIN
+                     DELETE FROM change_log WHERE table_name = 'fees_payments'
+                         AND row_id IN (SELECT id FROM fees_payments WHERE student_id = OLD.id);
+                     INSERT INTO change_log (table_name, row_id, op)
+                         SELECT 'fees_payments', id, 'delete' FROM fees_payments WHERE student_id = OLD.id;
+                 END''')
+    # Tombstone payments orphaned before the trigger above existed
+    c.execute('''SELECT cl.row_id FROM change_log cl
+                 JOIN fees_payments fp ON fp.id = cl.row_id
+                 LEFT JOIN students s ON fp.student_id = s.id
+                 WHERE cl.table_name = 'fees_payments' AND cl.op = 'upsert' AND s.id IS NULL''')
+    for (payment_id,) in c.fetchall():
+        c.execute("DELETE FROM change_log WHERE table_name = 'fees_payments' AND row_id = ?", (payment_id,))
+        c.execute("INSERT INTO change_log (table_name, row_id, op) VALUES ('fees_payments', ?, 'delete')", (payment_id,))
+
+def get_or_create_subject(c, course_id, semester, name):
+    name = str(name).strip()
+    c.execute('INSERT OR IGNORE INTO subjects (course_id, semester, name) VALUES (?, ?, ?)', (course_id, semester, name))
+    c.execute('SELECT id FROM subjects WHERE course_id = ? AND semester = ? AND name = ?', (course_id, semester, name))
+    return c.fetchone()[0]
+
+def set_exam_form_subjects(c, form_id, course_id, semester, subjects):
+    c.execute('DELETE FROM exam_form_subjects WHERE exam_form_id = ?', (form_id,))
+    for position, name in enumerate(subjects):
+        if not str(name).strip():
+            continue
+        subject_id = get_or_create_subject(c, course_id, semester, name)
+        c.execute('INSERT OR IGNORE INTO exam_form_subjects (exam_form_id, subject_id, position) VALUES (?, ?, ?)',
+                  (form_id, subject_id, position))
+
+def get_exam_form_subjects(c, form_ids):
+    # Returns {form_id: [subject names in form order]} in a single query
+    subjects = {form_id: [] for form_id in form_ids}
+    if not form_ids:
+        return subjects
+    placeholders = ','.join('?' * len(form_ids))
+    c.execute(f'''SELECT efs.exam_form_id, sub.name FROM exam_form_subjects efs
+                  JOIN subjects sub ON efs.subject_id = sub.id
+                  WHERE efs.exam_form_id IN ({placeholders})
+                  ORDER BY efs.exam_form_id, efs.position''', list(form_ids))
+    for form_id, name in c.fetchall():
+        subjects[form_id].append(name)
+    return subjects
+
+def migrate_exam_form_subjects(c):
+    # Move legacy JSON subjects into the catalog; migrated rows get subjects = NULL
+    c.execute('''SELECT ef.id, ef.subjects, s.course_id, s.semester FROM exam_forms ef
+                 LEFT JOIN students s ON ef.student_id = s.id
+                 WHERE ef.subjects IS NOT NULL''')
+    for form_id, subjects_json, course_id, semester in c.fetchall():
+        try:
+            subjects = json.loads(subjects_json)
+        except ValueError:
+            subjects = [subjects_json]
+        if not isinstance(subjects, list):
+            subjects = [subjects]
+        set_exam_form_subjects(c, form_id, course_id or 0, semester or '', subjects)
+        c.execute('UPDATE exam_forms SET subjects = NULL WHERE id = ?', (form_id,))
+
+# --- Tenants ---
+class PooledConnection(sqlite3.Connection):
+    # close() hands the connection back to its tenant's pool
+    pool_tenant = None
+    checkout = None
+
+    def close(self):
+        if self.pool_tenant is not None:
+            tenant, self.pool_tenant = self.pool_tenant, None
+            self.checkout = None
+            tenant.release(self)
+
+class Tenant:
+    def __init__(self, name):
+        self.name = name
+        if name == DEFAULT_TENANT:
+            self.root = os.path.dirname(os.path.abspath(__file__))
+            self.db_path, self.uploads_dir, self.sms_dir = DB_PATH, UPLOADS_DIR, SMS_DIR
+        else:
+            self.root = os.path.join(TENANTS_DIR, name)
+            self.db_path = os.path.join(self.root, 'student_mgmt.db')
+            self.uploads_dir = os.path.join(self.root, 'uploads')
+            self.sms_dir = os.path.join(self.root, 'SMS')
+        self.lock = threading.Lock()
+        self.idle = []
+        self.active_requests = 0
+        self.closed = False
+        self.payment_queue = queue.Queue()
+        self.payment_writer = None
+        self.pending_payments = 0
+
+    def acquire(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, factory=PooledConnection, check_same_thread=False)
+        conn.pool_tenant = self
+        conn.checkout = object()
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            if not self.closed and len(self.idle) < DB_POOL_SIZE:
+                self.idle.append(conn)
+                return
+        sqlite3.Connection.close(conn)
+
+    def is_idle(self):
+        return self.active_requests == 0 and self.pending_payments == 0
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            sqlite3.Connection.close(conn)
+        if self.payment_writer is not None:
+            self.payment_queue.put(None)
+
+_tenants = OrderedDict()
+_tenants_lock = threading.Lock()
+_tenant_init_lock = threading.Lock()
+
+def tenant_exists(name):
+    return name == DEFAULT_TENANT or os.path.isfile(os.path.join(TENANTS_DIR, name, 'student_mgmt.db'))
+
+def pin_open_tenant(name):
+    with _tenants_lock:
+        tenant = _tenants.get(name)
+        if tenant is not None:
+            _tenants.move_to_end(name)
+            tenant.active_requests += 1
+        return tenant
+
+def open_tenant(name):
+    # Returns the tenant with one active request pinned, so it cannot be evicted while in use
+    tenant = pin_open_tenant(name)
+    if tenant is not None:
+        return tenant
+    with _tenant_init_lock:
+        tenant = pin_open_tenant(name)
+        if tenant is not None:
+            return tenant
+        if not tenant_exists(name):
+            return None
+        tenant = Tenant(name)
+        # Opening a tenant applies any pending migrations
+        init_db(tenant.db_path)
+        with _tenants_lock:
+            _tenants[name] = tenant
+            tenant.active_requests += 1
+            # Least recently used idle tenants are closed first; busy ones are kept
+            for other in list(_tenants.values()):
+                if len(_tenants) <= MAX_OPEN_TENANTS:
+                    break
+                if other is not tenant and other.is_idle():
+                    del _tenants[other.name]
+                    other.close()
+    return tenant
+
+def release_tenant(tenant):
+    with _tenants_lock:
+        tenant.active_requests -= 1
+
+def resolve_tenant_name():
+    name = request.headers.get(TENANT_HEADER)
+    if not name and TENANT_DOMAIN:
+        host = request.host.split(':')[0].lower()
+        if host.endswith('.' + TENANT_DOMAIN):
+            name = host[:-len(TENANT_DOMAIN) - 1]
+    return (name or DEFAULT_TENANT).strip().lower()
+
+@app.before_request
+def load_tenant():
+    if request.method == 'OPTIONS':
+        return None
+    name = resolve_tenant_name()
+    tenant = open_tenant(name) if TENANT_NAME_RE.match(name) else None
+    if tenant is None:
+        return jsonify({'error': f'Unknown tenant: {name}'}), 404
+    g.tenant = tenant
+
+@app.teardown_request
+def release_db(exc):
+    for conn, checkout in g.pop('db_connections', []):
+        # Skip connections the handler already returned (they may belong to another request now)
+        if conn.checkout is checkout:
+            conn.close()
+    tenant = g.pop('tenant', None)
+    if tenant is not None:
+        release_tenant(tenant)
+
+def get_db():
+    # Pooled connection to the current tenant's database; returned to the pool on close()
+    # or at the end of the request
+    conn = g.tenant.acquire()
+    g.setdefault('db_connections', []).append((conn, conn.checkout))
+    return conn
+
+tenants_cli = AppGroup('tenants', help='Manage college tenants.')
+
+@tenants_cli.command('create')
+@click.argument('name')
+def create_tenant_command(name):
+    """Create a tenant with an empty database."""
+    name = name.lower()
+    if not TENANT_NAME_RE.match(name) or name == DEFAULT_TENANT:
+        raise click.BadParameter('Use lowercase letters, digits, "-" or "_"', param_hint='NAME')
+    if tenant_exists(name):
+        raise click.ClickException(f'Tenant already exists: {name}')
+    tenant = Tenant(name)
+    for path in (tenant.uploads_dir, tenant.sms_dir):
+        os.makedirs(path, exist_ok=True)
+    init_db(tenant.db_path)
+    click.echo(f'Created tenant {name} at {os.path.dirname(tenant.db_path)}')
+
+@tenants_cli.command('migrate')
+@click.argument('names', nargs=-1)
+def migrate_tenants_command(names):
+    """Apply schema migrations to the given tenants (default: all)."""
+    for name in names or list_tenant_names():
+        if not tenant_exists(name):
+            raise click.ClickException(f'Unknown tenant: {name}')
+        init_db(Tenant(name).db_path)
+        click.echo(f'Migrated {name}')
+
+@tenants_cli.command('list')
+def list_tenants_command():
+    """List tenants."""
+    for name in list_tenant_names():
+        click.echo(name)
+
+def list_tenant_names():
+    names = [DEFAULT_TENANT]
+    if os.path.isdir(TENANTS_DIR):
+        names += sorted(name for name in os.listdir(TENANTS_DIR) if name != DEFAULT_TENANT and tenant_exists(name))
+    return names
+
+app.cli.add_command(tenants_cli)
+
+# --- File Serving ---
+def file_version(path):
+    st = os.stat(path)
+    return f'{st.st_mtime_ns}-{st.st_size}'
+
+def serve_file(path, as_attachment=False, download_name=None, immutable=False):
+    # Streams the file from disk (wsgi.file_wrapper/sendfile where the server supports it).
+    # Range, ETag and Last-Modified/304 handling come from send_file(conditional=True).
+    if FILE_SERVE_MODE == 'x-accel':
+        rel_path = os.path.relpath(os.path.abspath(path), os.path.abspath(g.tenant.root)).replace(os.sep, '/')
+        rv = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        rv.headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX.rstrip('/')}/{g.tenant.name}/{quote(rel_path)}"
+        if as_attachment:
+            rv.headers.set('Content-Disposition', 'attachment', filename=download_name or os.path.basename(path))
+    else:
+        rv = send_file(path, as_attachment=as_attachment, download_name=download_name, conditional=True, etag=True)
+    rv.cache_control.private = True
+    if immutable:
+        rv.cache_control.no_cache = None
+        rv.cache_control.max_age = FILE_CACHE_MAX_AGE
+        rv.cache_control.immutable = True
+    else:
+        rv.cache_control.no_cache = True
+    return rv
+
+def get_student_file_dirs(student_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''SELECT s.name, s.year, s.semester, c.name, b.name FROM students s
+                 LEFT JOIN courses c ON s.course_id = c.id
+                 LEFT JOIN batches b ON s.batch_id = b.id
+                 WHERE s.id = ?''', (student_id,))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return None
+    student_name, year, semester, course_name, batch_name = row
+    upload_dir = os.path.join(g.tenant.uploads_dir, str(course_name), str(batch_name), str(year), str(semester), str(student_name).replace(' ', '_'))
+    return {
+        'documents': os.path.join(upload_dir, 'documents'),
+        'exam_form': os.path.join(upload_dir, 'exam_form'),
+        'generated': os.path.join(g.tenant.sms_dir, course_name or 'Unknown', batch_name or 'Unknown', str(year), str(student_name).replace(' ', '_')),
+    }
+
+# --- Fee Payment Ingestion ---
+# Payments are written by a single background writer that commits them in groups:
+# it waits up to PAYMENT_BATCH_DELAY for more payments (or PAYMENT_BATCH_SIZE of them)
+# and commits them in one transaction, so many requests share one fsync.
+PAYMENT_BATCH_SIZE = 100
+PAYMENT_BATCH_DELAY = 0.005
+PAYMENT_ACK_TIMEOUT = 30
+
+class PendingPayment:
+    def __init__(self, values, idempotency_key):
+        self.values = values
+        self.idempotency_key = idempotency_key
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # 'queued' -> 'writing' (claimed by the writer) or 'cancelled' (caller timed out)
+        self.state = 'queued'
+        self.state_lock = threading.Lock()
+
+    def claim(self):
+        with self.state_lock:
+            if self.state == 'queued':
+                self.state = 'writing'
+                return True
+            return False
+
+    def cancel(self):
+        with self.state_lock:
+            if self.state == 'queued':
+                self.state = 'cancelled'
+                return True
+            return False
+
+def submit_fees_payment(tenant, student_id, amount, mode, date, note, idempotency_key=None):
+    # Blocks until the payment's batch is committed; returns (payment_id, status)
+    # where status is 'created', 'duplicate' or 'conflict'
+    with tenant.lock:
+        if tenant.payment_writer is None or not tenant.payment_writer.is_alive():
+            tenant.payment_writer = threading.Thread(target=payment_writer_loop, args=(tenant,),
+                                                     name=f'payment-writer-{tenant.name}', daemon=True)
+            tenant.payment_writer.start()
+        tenant.pending_payments += 1
+    payment = PendingPayment((student_id, amount, mode, date, note), idempotency_key)
+    tenant.payment_queue.put(payment)
+    try:
+        if not payment.done.wait(PAYMENT_ACK_TIMEOUT):
+            # Cancelled payments are never written, so a retry cannot duplicate them.
+            # If the writer already claimed it, its batch is in flight: wait for the outcome.
+            if payment.cancel():
+                raise TimeoutError('Payment was not committed in time')
+            payment.done.wait()
+    finally:
+        with tenant.lock:
+            tenant.pending_payments -= 1
+    if payment.error:
+        raise sqlite3.DatabaseError(payment.error)
+    return payment.result
+
+def payment_writer_loop(tenant):
+    conn = sqlite3.connect(tenant.db_path, isolation_level=None)
+    conn.execute('PRAGMA synchronous=FULL')
+    while True:
+        payment = tenant.payment_queue.get()
+        if payment is None:
+            # Tenant was evicted
+            break
+        batch = [payment]
+        deadline = time.monotonic() + PAYMENT_BATCH_DELAY
+        while len(batch) < PAYMENT_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                payment = tenant.payment_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if payment is None:
+                tenant.payment_queue.put(None)
+                break
+            batch.append(payment)
+        try:
+            write_payment_batch(conn, batch)
+        except Exception:
+            # Callers were already signalled; start over with a fresh connection
+            app.logger.exception('Payment batch failed for tenant %s', tenant.name)
+            conn.close()
+            conn = sqlite3.connect(tenant.db_path, isolation_level=None)
+            conn.execute('PRAGMA synchronous=FULL')
+    conn.close()
+
+def write_payment_batch(conn, batch):
+    batch = [payment for payment in batch if payment.claim()]
+    if not batch:
+        return
+    try:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        for payment in batch:
+            # Savepoint per payment so one bad row does not fail the whole batch
+            c.execute('SAVEPOINT payment')
+            try:
+                payment.result = insert_fees_payment(c, payment)
+                c.execute('RELEASE payment')
+            except sqlite3.Error as e:
+                c.execute('ROLLBACK TO payment')
+                c.execute('RELEASE payment')
+                payment.error = str(e)
+        c.execute('COMMIT')
+    except Exception as e:
+        # Nothing in the batch was committed
+        for payment in batch:
+            payment.result = None
+            payment.error = str(e) or 'Payment batch failed'
+        if conn.in_transaction:
+            conn.rollback()
+    finally:
+        # Every claimed caller is woken, whatever happened above
+        for payment in batch:
+            if payment.result is None and payment.error is None:
+                payment.error = 'Payment batch failed'
+            payment.done.set()
+
+def insert_fees_payment(c, payment):
+    c.execute('''INSERT INTO fees_payments (student_id, amount, mode, date, note, idempotency_key)
+                 VALUES (?, ?, ?, ?, ?, ?)
+                 ON CONFLICT(idempotency_key) DO NOTHING''', payment.values + (payment.idempotency_key,))
+    if c.rowcount == 1:
+        return c.lastrowid, 'created'
+    # Key already used: same payment is a replay, anything else is a conflict
+    c.execute('SELECT id, student_id, amount, mode, date FROM fees_payments WHERE idempotency_key = ?', (payment.idempotency_key,))
+    row = c.fetchone()
+    student_id, amount, mode, date, _ = payment.values
+    same = str(row[1]) == str(student_id) and float(row[2]) == float(amount) and row[3] == mode and row[4] == date
+    return row[0], 'duplicate' if same else 'conflict'
 
 # --- API Endpoints ---
 @app.route('/api/courses', methods=['GET'])
 def get_courses():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id, name FROM courses')
     courses = [{'id': row[0], 'name': row[1]} for row in c.fetchall()]
@@ -96,7 +635,7 @@ def add_course():
     name = data.get('name')
     if not name:
         return jsonify({'error': 'Course name required'}), 400
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     try:
         c.execute('INSERT INTO courses (name) VALUES (?)', (name,))
@@ -114,7 +653,7 @@ def update_course(course_id):
     name = data.get('name')
     if not name:
         return jsonify({'error': 'Course name required'}), 400
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     try:
         c.execute('UPDATE courses SET name = ? WHERE id = ?', (name, course_id))
@@ -130,7 +669,7 @@ def update_course(course_id):
 
 @app.route('/api/courses/<int:course_id>', methods=['DELETE'])
 def delete_course(course_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     # Check if course has batches
     c.execute('SELECT COUNT(*) FROM batches WHERE course_id = ?', (course_id,))
@@ -157,7 +696,7 @@ def delete_course(course_id):
 @app.route('/api/batches', methods=['GET'])
 def get_batches():
     course_id = request.args.get('course_id')
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     if course_id:
         c.execute('SELECT id, name, course_id FROM batches WHERE course_id = ?', (course_id,))
@@ -174,7 +713,7 @@ def add_batch():
     course_id = data.get('course_id')
     if not name or not course_id:
         return jsonify({'error': 'Batch name and course_id required'}), 400
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('INSERT INTO batches (name, course_id) VALUES (?, ?)', (name, course_id))
     conn.commit()
@@ -189,7 +728,7 @@ def update_batch(batch_id):
     course_id = data.get('course_id')
     if not name or not course_id:
         return jsonify({'error': 'Batch name and course_id required'}), 400
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('UPDATE batches SET name = ?, course_id = ? WHERE id = ?', (name, course_id, batch_id))
     conn.commit()
@@ -201,7 +740,7 @@ def update_batch(batch_id):
 
 @app.route('/api/batches/<int:batch_id>', methods=['DELETE'])
 def delete_batch(batch_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     # Check if batch has students
     c.execute('SELECT COUNT(*) FROM students WHERE batch_id = ?', (batch_id,))
@@ -224,7 +763,7 @@ def add_student():
     required = ['name', 'father_name', 'dob', 'mobile', 'email', 'gender', 'admission_date', 'year', 'semester', 'course_id', 'batch_id']
     if not all(k in data and data[k] for k in required):
         return jsonify({'error': 'Missing required fields'}), 400
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('''INSERT INTO students (name, father_name, dob, mobile, email, gender, admission_date, year, semester, course_id, batch_id)
                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
@@ -234,36 +773,40 @@ def add_student():
     conn.close()
     return jsonify({'id': student_id}), 201
 
+STUDENT_SELECT = '''SELECT s.id, s.name, s.father_name, s.dob, s.mobile, s.email, s.gender, s.admission_date, s.year, s.semester,
+                            s.course_id, s.batch_id, s.fees_total, c.name as course_name, b.name as batch_name,
+                            s.updated_at, s.change_seq
+                     FROM students s
+                     LEFT JOIN courses c ON s.course_id = c.id
+                     LEFT JOIN batches b ON s.batch_id = b.id'''
+
+def student_to_dict(row):
+    return {
+        'id': row[0],
+        'name': row[1],
+        'father_name': row[2],
+        'dob': row[3],
+        'mobile': row[4],
+        'email': row[5],
+        'gender': row[6],
+        'admission_date': row[7],
+        'year': row[8],
+        'semester': row[9],
+        'course_id': row[10],
+        'batch_id': row[11],
+        'fees_total': row[12],
+        'course': row[13],
+        'batch': row[14],
+        'updated_at': row[15],
+        'change_seq': row[16],
+    }
+
 @app.route('/api/students', methods=['GET'])
 def get_students():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT s.id, s.name, s.father_name, s.dob, s.mobile, s.email, s.gender, s.admission_date, s.year, s.semester,
-                        s.course_id, s.batch_id, s.fees_total, c.name as course_name, b.name as batch_name
-                 FROM students s
-                 LEFT JOIN courses c ON s.course_id = c.id
-                 LEFT JOIN batches b ON s.batch_id = b.id
-                 ORDER BY s.id DESC''')
-    students = [
-        {
-            'id': row[0],
-            'name': row[1],
-            'father_name': row[2],
-            'dob': row[3],
-            'mobile': row[4],
-            'email': row[5],
-            'gender': row[6],
-            'admission_date': row[7],
-            'year': row[8],
-            'semester': row[9],
-            'course_id': row[10],
-            'batch_id': row[11],
-            'fees_total': row[12],
-            'course': row[13],
-            'batch': row[14],
-        }
-        for row in c.fetchall()
-    ]
+    c.execute(STUDENT_SELECT + ' ORDER BY s.id DESC')
+    students = [student_to_dict(row) for row in c.fetchall()]
     conn.close()
     return jsonify(students)
 
@@ -273,7 +816,7 @@ def update_student(student_id):
     required = ['name', 'father_name', 'dob', 'mobile', 'email', 'gender', 'admission_date', 'year', 'semester', 'course_id', 'batch_id', 'fees_total']
     if not all(k in data and data[k] for k in required):
         return jsonify({'error': 'Missing required fields'}), 400
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('''UPDATE students SET name=?, father_name=?, dob=?, mobile=?, email=?, gender=?, admission_date=?, year=?, semester=?, course_id=?, batch_id=?, fees_total=? WHERE id=?''',
               (data['name'], data['father_name'], data['dob'], data['mobile'], data['email'], data['gender'], data['admission_date'], data['year'], data['semester'], data['course_id'], data['batch_id'], data['fees_total'], student_id))
@@ -283,7 +826,7 @@ def update_student(student_id):
 
 @app.route('/api/students/<int:student_id>', methods=['DELETE'])
 def delete_student(student_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('DELETE FROM students WHERE id=?', (student_id,))
     conn.commit()
@@ -296,68 +839,139 @@ def add_exam_form():
     required = ['student_id', 'exam_date', 'subjects']
     if not all(k in data and data[k] for k in required):
         return jsonify({'error': 'Missing required fields'}), 400
-    import json
-    conn = sqlite3.connect(DB_PATH)
+    subjects = data['subjects'] if isinstance(data['subjects'], list) else [data['subjects']]
+    conn = get_db()
     c = conn.cursor()
-    c.execute('''INSERT INTO exam_forms (student_id, exam_date, subjects) VALUES (?, ?, ?)''',
-              (data['student_id'], data['exam_date'], json.dumps(data['subjects'])))
-    conn.commit()
+    c.execute('SELECT course_id, semester FROM students WHERE id = ?', (data['student_id'],))
+    student = c.fetchone()
+    if not student:
+        conn.close()
+        return jsonify({'error': 'Student not found'}), 404
+    course_id, semester = student
+    c.execute('''INSERT INTO exam_forms (student_id, exam_date) VALUES (?, ?)''',
+              (data['student_id'], data['exam_date']))
     form_id = c.lastrowid
+    set_exam_form_subjects(c, form_id, course_id or 0, semester or '', subjects)
+    conn.commit()
     conn.close()
     return jsonify({'id': form_id}), 201
 
+EXAM_FORM_SELECT = 'SELECT id, student_id, exam_date, created_at, updated_at, change_seq FROM exam_forms'
+
+def exam_forms_to_dicts(c, rows):
+    subjects = get_exam_form_subjects(c, [row[0] for row in rows])
+    return [
+        {
+            'id': row[0],
+            'student_id': row[1],
+            'exam_date': row[2],
+            'subjects': subjects[row[0]],
+            'created_at': row[3],
+            'updated_at': row[4],
+            'change_seq': row[5],
+        }
+        for row in rows
+    ]
+
 @app.route('/api/exam_forms', methods=['GET'])
 def get_exam_forms():
     student_id = request.args.get('student_id')
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     if student_id:
-        c.execute('''SELECT id, student_id, exam_date, subjects, created_at FROM exam_forms WHERE student_id = ? ORDER BY created_at DESC''', (student_id,))
+        c.execute(EXAM_FORM_SELECT + ' WHERE student_id = ? ORDER BY created_at DESC', (student_id,))
     else:
-        c.execute('''SELECT id, student_id, exam_date, subjects, created_at FROM exam_forms ORDER BY created_at DESC''')
-    import json
-    forms = [
-        {
-            'id': row[0],
-            'student_id': row[1],
-            'exam_date': row[2],
-            'subjects': json.loads(row[3]),
-            'created_at': row[4],
-        }
+        c.execute(EXAM_FORM_SELECT + ' ORDER BY created_at DESC')
+    forms = exam_forms_to_dicts(c, c.fetchall())
+    conn.close()
+    return jsonify(forms)
+
+@app.route('/api/subjects', methods=['GET'])
+def get_subjects():
+    course_id = request.args.get('course_id')
+    semester = request.args.get('semester')
+    conn = get_db()
+    c = conn.cursor()
+    query = 'SELECT id, course_id, semester, name FROM subjects WHERE 1=1'
+    params = []
+    if course_id:
+        query += ' AND course_id = ?'
+        params.append(course_id)
+    if semester:
+        query += ' AND semester = ?'
+        params.append(semester)
+    query += ' ORDER BY course_id, semester, name'
+    c.execute(query, params)
+    subjects = [{'id': row[0], 'course_id': row[1], 'semester': row[2], 'name': row[3]} for row in c.fetchall()]
+    conn.close()
+    return jsonify(subjects)
+
+@app.route('/api/exam_forms/subject_counts', methods=['GET'])
+def exam_form_subject_counts():
+    course_id = request.args.get('course_id')
+    batch_id = request.args.get('batch_id')
+    semester = request.args.get('semester')
+    conn = get_db()
+    c = conn.cursor()
+    query = '''SELECT sub.id, sub.name, sub.course_id, sub.semester, COUNT(DISTINCT ef.student_id)
+               FROM exam_form_subjects efs
+               JOIN subjects sub ON efs.subject_id = sub.id
+               JOIN exam_forms ef ON efs.exam_form_id = ef.id
+               JOIN students s ON ef.student_id = s.id
+               WHERE 1=1'''
+    params = []
+    if course_id:
+        query += ' AND sub.course_id = ?'
+        params.append(course_id)
+    if semester:
+        query += ' AND sub.semester = ?'
+        params.append(semester)
+    if batch_id:
+        query += ' AND s.batch_id = ?'
+        params.append(batch_id)
+    query += ' GROUP BY sub.id ORDER BY sub.course_id, sub.semester, sub.name'
+    c.execute(query, params)
+    counts = [
+        {'subject_id': row[0], 'name': row[1], 'course_id': row[2], 'semester': row[3], 'registered': row[4]}
         for row in c.fetchall()
     ]
     conn.close()
-    return jsonify(forms)
+    return jsonify(counts)
 
 @app.route('/api/exam_forms/<int:form_id>/pdf', methods=['GET'])
 def get_exam_form_pdf(form_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT ef.exam_date, ef.subjects, s.name, s.course_id, s.batch_id, s.year, s.semester, s.id
+    c.execute('''SELECT ef.exam_date, s.name, COALESCE(c.name, 'Unknown'), COALESCE(b.name, 'Unknown'), s.year, s.semester, s.id,
+                        MAX(COALESCE(ef.created_at, ''), COALESCE(ef.updated_at, ''), COALESCE(s.updated_at, ''))
                  FROM exam_forms ef
                  JOIN students s ON ef.student_id = s.id
+                 LEFT JOIN courses c ON s.course_id = c.id
+                 LEFT JOIN batches b ON s.batch_id = b.id
                  WHERE ef.id = ?''', (form_id,))
     row = c.fetchone()
-    conn.close()
     if not row:
+        conn.close()
         return jsonify({'error': 'Exam form not found'}), 404
-    exam_date, subjects_json, student_name, course_id, batch_id, year, semester, student_id = row
-    subjects = json.loads(subjects_json)
-    # Get course and batch names
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT name FROM courses WHERE id = ?', (course_id,))
-    course_name = c.fetchone()[0] if c.fetchone() else 'Unknown'
-    c.execute('SELECT name FROM batches WHERE id = ?', (batch_id,))
-    batch_name = c.fetchone()[0] if c.fetchone() else 'Unknown'
+    exam_date, student_name, course_name, batch_name, year, semester, student_id, changed_at = row
+    subjects = get_exam_form_subjects(c, [form_id])[form_id]
     conn.close()
     # Folder structure
-    base_dir = os.path.join(os.path.dirname(__file__), 'SMS', course_name, batch_name, year, student_name.replace(' ', '_'))
+    base_dir = os.path.join(g.tenant.sms_dir, course_name, batch_name, year, student_name.replace(' ', '_'))
     os.makedirs(base_dir, exist_ok=True)
-    pdf_path = os.path.join(base_dir, f'ExamForm_{exam_date}.pdf')
-    # Generate PDF
-    buffer = io.BytesIO()
-    p = canvas.Canvas(buffer, pagesize=A4)
+    # One file per form: forms can share an exam date but differ in subjects
+    pdf_path = os.path.join(base_dir, f'ExamForm_{form_id}_{exam_date}.pdf')
+    download_name = f'ExamForm_{exam_date}.pdf'
+    # Reuse the PDF unless the form or student changed after it was written, so its ETag stays stable
+    if changed_at and os.path.isfile(pdf_path):
+        changed_ts = datetime.strptime(changed_at, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+        # Timestamps have second resolution, so only trust files written after that second ended
+        if os.path.getmtime(pdf_path) >= changed_ts + 1:
+            return serve_file(pdf_path, as_attachment=True, download_name=download_name, immutable=False)
+    # Render to a temp file and swap it in, so readers never see a half-written PDF
+    fd, tmp_path = tempfile.mkstemp(prefix='.ExamForm_', suffix='.pdf.tmp', dir=base_dir)
+    os.close(fd)
+    p = canvas.Canvas(tmp_path, pagesize=A4)
     p.setFont('Helvetica-Bold', 16)
     p.drawString(100, 800, 'Exam Form')
     p.setFont('Helvetica', 12)
@@ -373,13 +987,16 @@ def get_exam_form_pdf(form_id):
         p.drawString(120, y, f'{idx}. {subj}')
         y -= 20
     p.showPage()
-    p.save()
-    buffer.seek(0)
-    # Save PDF to disk
-    with open(pdf_path, 'wb') as f:
-        f.write(buffer.getvalue())
-    buffer.seek(0)
-    return send_file(buffer, as_attachment=True, download_name=f'ExamForm_{exam_date}.pdf', mimetype='application/pdf')
+    try:
+        p.save()
+        # mkstemp creates 0600 files; keep the PDF readable by a front proxy
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, pdf_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return serve_file(pdf_path, as_attachment=True, download_name=download_name, immutable=False)
 
 @app.route('/api/promote_batch', methods=['POST'])
 def promote_batch():
@@ -393,7 +1010,7 @@ def promote_batch():
     to_batch_id = data['to_batch_id']
     to_year = data['to_year']
     to_semester = data['to_semester']
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     # Get students to promote
     c.execute('SELECT id, fees_total FROM students WHERE batch_id=? AND year=? AND semester=?', (from_batch_id, from_year, from_semester))
@@ -423,7 +1040,7 @@ def passout_students():
     batch_id = data['batch_id']
     year = data['year']
     semester = data['semester']
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     # Delete students in this batch/year/semester
     c.execute('''DELETE FROM students WHERE batch_id=? AND year=? AND semester=?''', (batch_id, year, semester))
@@ -446,7 +1063,7 @@ def promote_all():
         '1st Semester', '2nd Semester', '3rd Semester', '4th Semester',
         '5th Semester', '6th Semester', '7th Semester', '8th Semester'
     ]
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     # Get all students with course, year, semester, batch
     c.execute('''SELECT s.id, s.course_id, s.batch_id, s.year, s.semester, c.name as course_name
@@ -514,7 +1131,7 @@ def upload_student_document(student_id):
     if not doc_type or not file or not allowed_file(file.filename):
         return jsonify({'error': 'Missing or invalid file/doc_type'}), 400
     # Get student info for folder structure
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('''SELECT s.name, s.year, s.semester, c.name, b.name FROM students s
                  LEFT JOIN courses c ON s.course_id = c.id
@@ -525,7 +1142,7 @@ def upload_student_document(student_id):
     if not row:
         return jsonify({'error': 'Student not found'}), 404
     student_name, year, semester, course_name, batch_name = row
-    base_dir = os.path.join(os.path.dirname(__file__), 'uploads', str(course_name), str(batch_name), str(year), str(semester), str(student_name).replace(' ', '_'), 'documents')
+    base_dir = os.path.join(g.tenant.uploads_dir, str(course_name), str(batch_name), str(year), str(semester), str(student_name).replace(' ', '_'), 'documents')
     os.makedirs(base_dir, exist_ok=True)
     filename = secure_filename(f"{doc_type}_{file.filename}")
     file.save(os.path.join(base_dir, filename))
@@ -538,7 +1155,7 @@ def upload_exam_form(student_id):
     if not file or not allowed_file(file.filename):
         return jsonify({'error': 'Missing or invalid file'}), 400
     # Get student info for folder structure
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('''SELECT s.name, s.year, s.semester, c.name, b.name FROM students s
                  LEFT JOIN courses c ON s.course_id = c.id
@@ -549,7 +1166,7 @@ def upload_exam_form(student_id):
     if not row:
         return jsonify({'error': 'Student not found'}), 404
     student_name, year, semester, course_name, batch_name = row
-    base_dir = os.path.join(os.path.dirname(__file__), 'uploads', str(course_name), str(batch_name), str(year), str(semester), str(student_name).replace(' ', '_'), 'exam_form')
+    base_dir = os.path.join(g.tenant.uploads_dir, str(course_name), str(batch_name), str(year), str(semester), str(student_name).replace(' ', '_'), 'exam_form')
     os.makedirs(base_dir, exist_ok=True)
     filename = secure_filename(file.filename)
     file.save(os.path.join(base_dir, filename))
@@ -558,7 +1175,7 @@ def upload_exam_form(student_id):
 @app.route('/api/students/<int:student_id>/exam_form_status', methods=['GET'])
 def exam_form_status(student_id):
     import glob
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('''SELECT s.name, s.year, s.semester, c.name, b.name FROM students s
                  LEFT JOIN courses c ON s.course_id = c.id
@@ -569,13 +1186,48 @@ def exam_form_status(student_id):
     if not row:
         return jsonify({'uploaded': False, 'filenames': []})
     student_name, year, semester, course_name, batch_name = row
-    base_dir = os.path.join(os.path.dirname(__file__), 'uploads', str(course_name), str(batch_name), str(year), str(semester), str(student_name).replace(' ', '_'), 'exam_form')
+    base_dir = os.path.join(g.tenant.uploads_dir, str(course_name), str(batch_name), str(year), str(semester), str(student_name).replace(' ', '_'), 'exam_form')
     files = []
     for ext in ['pdf', 'jpg', 'jpeg', 'png']:
         files.extend(glob.glob(os.path.join(base_dir, f'*.{ext}')))
     filenames = [os.path.basename(f) for f in files]
     return jsonify({'uploaded': bool(filenames), 'filenames': filenames})
 
+@app.route('/api/students/<int:student_id>/files', methods=['GET'])
+def list_student_files(student_id):
+    dirs = get_student_file_dirs(student_id)
+    if dirs is None:
+        return jsonify({'error': 'Student not found'}), 404
+    files = {}
+    for kind, base_dir in dirs.items():
+        files[kind] = []
+        if not os.path.isdir(base_dir):
+            continue
+        for filename in sorted(os.listdir(base_dir)):
+            path = os.path.join(base_dir, filename)
+            # Hidden files are in-progress temp files
+            if filename.startswith('.') or not os.path.isfile(path):
+                continue
+            version = file_version(path)
+            files[kind].append({
+                'filename': filename,
+                'size': os.path.getsize(path),
+                'url': f'/api/students/{student_id}/files/{kind}/{quote(filename)}?v={version}',
+            })
+    return jsonify(files)
+
+@app.route('/api/students/<int:student_id>/files/<kind>/<path:filename>', methods=['GET'])
+def get_student_file(student_id, kind, filename):
+    dirs = get_student_file_dirs(student_id)
+    if dirs is None or kind not in dirs:
+        return jsonify({'error': 'File not found'}), 404
+    path = safe_join(dirs[kind], filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({'error': 'File not found'}), 404
+    # Versioned URLs (?v=<mtime>-<size>) never change content, so they can be cached for good
+    immutable = request.args.get('v') == file_version(path)
+    return serve_file(path, as_attachment=request.args.get('download') == '1', immutable=immutable)
+
 @app.route('/api/students/<int:student_id>/add_fees_payment', methods=['POST'])
 def add_fees_payment(student_id):
     data = request.json
@@ -583,19 +1235,29 @@ def add_fees_payment(student_id):
     mode = data.get('mode')
     date = data.get('date')
     note = data.get('note', '')
+    # Client-supplied key makes retries and double-clicks safe
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
     if not amount or not mode or not date:
         return jsonify({'error': 'Missing required fields'}), 400
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT INTO fees_payments (student_id, amount, mode, date, note) VALUES (?, ?, ?, ?, ?)',
-              (student_id, amount, mode, date, note))
-    conn.commit()
-    conn.close()
-    return jsonify({'success': True})
+    if idempotency_key is not None and (not isinstance(idempotency_key, str) or len(idempotency_key) > 255):
+        return jsonify({'error': 'idempotency_key must be a string of at most 255 characters'}), 400
+    try:
+        amount = float(amount)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid amount'}), 400
+    try:
+        payment_id, status = submit_fees_payment(g.tenant, student_id, amount, mode, date, note, idempotency_key or None)
+    except TimeoutError:
+        return jsonify({'error': 'Payment could not be saved, please retry'}), 503
+    except sqlite3.DatabaseError as e:
+        return jsonify({'error': str(e)}), 500
+    if status == 'conflict':
+        return jsonify({'error': 'Idempotency key already used for a different payment', 'id': payment_id}), 409
+    return jsonify({'success': True, 'id': payment_id, 'duplicate': status == 'duplicate'})
 
 @app.route('/api/students/<int:student_id>/fees_history', methods=['GET'])
 def fees_history(student_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id, amount, mode, date, note FROM fees_payments WHERE student_id = ? ORDER BY date DESC, id DESC', (student_id,))
     history = [
@@ -609,7 +1271,7 @@ def fees_collection_summary():
     from_date = request.args.get('from')
     to_date = request.args.get('to')
     mode = request.args.get('mode')
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     query = 'SELECT date, mode, SUM(amount) FROM fees_payments WHERE 1=1'
     params = []
@@ -634,13 +1296,39 @@ def fees_collection_summary():
 def delete_fees_payment(payment_id):
     if request.method == 'OPTIONS':
         return '', 200
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute('DELETE FROM fees_payments WHERE id=?', (payment_id,))
     conn.commit()
     conn.close()
     return jsonify({'success': True})
 
+PAYMENT_SELECT = '''SELECT fp.id, fp.student_id, s.name, s.course_id, c.name, s.batch_id, b.name, s.year, s.semester, fp.amount, fp.mode, fp.date, fp.note,
+                            fp.updated_at, fp.change_seq
+                     FROM fees_payments fp
+                     JOIN students s ON fp.student_id = s.id
+                     LEFT JOIN courses c ON s.course_id = c.id
+                     LEFT JOIN batches b ON s.batch_id = b.id'''
+
+def payment_to_dict(row):
+    return {
+        'id': row[0],
+        'student_id': row[1],
+        'student_name': row[2],
+        'course_id': row[3],
+        'course': row[4],
+        'batch_id': row[5],
+        'batch': row[6],
+        'year': row[7],
+        'semester': row[8],
+        'amount': row[9],
+        'mode': row[10],
+        'date': row[11],
+        'note': row[12],
+        'updated_at': row[13],
+        'change_seq': row[14],
+    }
+
 @app.route('/api/fees_payments', methods=['GET'])
 def get_fees_payments():
     from_date = request.args.get('from')
@@ -649,14 +1337,9 @@ def get_fees_payments():
     batch_id = request.args.get('batch_id')
     year = request.args.get('year')
     semester = request.args.get('semester')
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
-    query = '''SELECT fp.id, fp.student_id, s.name, s.course_id, c.name, s.batch_id, b.name, s.year, s.semester, fp.amount, fp.mode, fp.date, fp.note
-               FROM fees_payments fp
-               JOIN students s ON fp.student_id = s.id
-               LEFT JOIN courses c ON s.course_id = c.id
-               LEFT JOIN batches b ON s.batch_id = b.id
-               WHERE 1=1'''
+    query = PAYMENT_SELECT + ' WHERE 1=1'
     params = []
     if from_date:
         query += ' AND fp.date >= ?'
@@ -678,27 +1361,49 @@ def get_fees_payments():
         params.append(semester)
     query += ' ORDER BY fp.date DESC, fp.id DESC'
     c.execute(query, params)
-    payments = [
-        {
-            'id': row[0],
-            'student_id': row[1],
-            'student_name': row[2],
-            'course_id': row[3],
-            'course': row[4],
-            'batch_id': row[5],
-            'batch': row[6],
-            'year': row[7],
-            'semester': row[8],
-            'amount': row[9],
-            'mode': row[10],
-            'date': row[11],
-            'note': row[12],
-        }
-        for row in c.fetchall()
-    ]
+    payments = [payment_to_dict(row) for row in c.fetchall()]
     conn.close()
     return jsonify(payments)
 
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    # Delta sync: rows created/updated/deleted after change sequence `since`
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(int(request.args.get('limit', 1000)), 5000)
+    except ValueError:
+        return jsonify({'error': 'since and limit must be integers'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'limit must be positive'}), 400
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT seq, table_name, row_id, op FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?', (since, limit))
+    changes = c.fetchall()
+    upserted = {table: [] for table in TRACKED_TABLES}
+    result = {table: {'upserted': [], 'deleted': []} for table in TRACKED_TABLES}
+    for seq, table, row_id, op in changes:
+        if op == 'delete':
+            result[table]['deleted'].append(row_id)
+        else:
+            upserted[table].append(row_id)
+    selects = {
+        'students': (STUDENT_SELECT, 's.id', lambda rows: [student_to_dict(row) for row in rows]),
+        'fees_payments': (PAYMENT_SELECT, 'fp.id', lambda rows: [payment_to_dict(row) for row in rows]),
+        'exam_forms': (EXAM_FORM_SELECT, 'id', lambda rows: exam_forms_to_dicts(c, rows)),
+    }
+    for table, ids in upserted.items():
+        # Chunked to stay under SQLite's bound parameter limit
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            select, id_column, to_dicts = selects[table]
+            c.execute(f"{select} WHERE {id_column} IN ({','.join('?' * len(chunk))})", chunk)
+            result[table]['upserted'].extend(to_dicts(c.fetchall()))
+    conn.close()
+    result['since'] = since
+    result['next'] = changes[-1][0] if changes else since
+    result['has_more'] = len(changes) == limit
+    return jsonify(result)
+
 @app.route('/api/students/bulk_upload', methods=['POST'])
 def bulk_upload_students():
     if 'file' not in request.files:
@@ -713,7 +1418,7 @@ def bulk_upload_students():
     reader = csv.DictReader(stream.splitlines())
     required = ['name', 'father_name', 'dob', 'mobile', 'email', 'gender', 'admission_date', 'year', 'semester']
     results = []
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     for i, row in enumerate(reader, 2):  # start at line 2 (after header)
         # Validate required fields